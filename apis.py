@@ -1,119 +1,204 @@
 import pathlib
+import posixpath
 import logging
 import traceback
 import urllib.parse
 import functools
 import inspect
-from typing import Optional
+import string
+import threading
+import types
+from typing import Any, Optional
 
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from httplib2 import Http
 from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2 import credentials
 from googleapiclient.discovery import build, Resource
 from googleapiclient.http import HttpRequest
 
-from helpers import request, parse_response
+from helpers import request, parse_response, SingleFlight, get_last_dir, get_parents
 
 logger = logging.getLogger(__name__)
 
 
+class LockedAuthorizedHttp(AuthorizedHttp):
+
+    def __init__(self, *args, refresh_lock: threading.Lock = None, **kwds) -> None:
+        super(LockedAuthorizedHttp, self).__init__(*args, **kwds)
+        self._refresh_lock = refresh_lock or threading.Lock()
+
+    def request(self, *args, **kwds):
+        '''override'''
+        # 만료된 토큰은 한 스레드만 갱신하고 나머지는 갱신된 토큰을 사용
+        if not self.credentials.valid:
+            with self._refresh_lock:
+                if not self.credentials.valid:
+                    self.credentials.refresh(self._request)
+        return super(LockedAuthorizedHttp, self).request(*args, **kwds)
+
+
+class ThreadLocalHttp:
+
+    def __init__(self, factory: callable) -> None:
+        self._factory = factory
+        self._local = threading.local()
+
+    @property
+    def http(self) -> AuthorizedHttp:
+        # httplib2.Http는 스레드 간에 공유할 수 없으므로 스레드마다 하나씩 만들어서 연결을 재사용
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self._factory()
+        return http
+
+    def request(self, *args, **kwds):
+        return self.http.request(*args, **kwds)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.http, name)
+
+
+class HttpApi:
+    """
+    api에 추가적인 데이터가 필요한 경우 딕셔너리 형태로 리턴
+
+        @Api.http_api('/path/{sub_path}/{extra_path}', method='POST')
+        def test(self, sub_path: str, param1: str, param2: int, data1: str, data2: str) -> dict:
+            return {
+                'params': {
+                    'a': param1,
+                    'b': parma2,
+                },
+                'data': {
+                    'c': data1,
+                    'd': data2,
+                },
+                'headers': {
+                    'Accept': 'application/json'
+                },
+                'auth: ('user', 'password'),
+                'format': {
+                    'extra_path': 'additonal_path',
+                }
+            }
+
+    api에 추가적인 데이터가 필요하지 않은 경우 리턴하지 않음
+
+        @Api.http_api('/version')
+        def no_return(self) -> dict:
+            pass
+
+    api 경로는 python 포멧 형식으로 작성할 수 있고 포멧 키워드는 메소드에서 입력받은 동일한 이름의 파라미터 값으로 대체 됨
+
+        @Api.http_api('/path/{sub_path}', method='POST')
+        def test(self, sub_path: str) -> dict:
+            pass
+
+        test('login') -> '/path/login'
+
+    혹은 'format' 값을 직접 return 하여 동적으로 api 경로를 생성할 수 있음
+
+        @Api.http_api('/path/{sub_path}/{extra_path}')
+        def test(self, sub_path: str) -> dict:
+            return {
+                'format': {
+                    'extra_path': 'users',
+                }
+            }
+
+        test('group') -> '/path/group/users'
+    """
+
+    def __init__(self, path: str, method: str, func: callable) -> None:
+        self.path = path
+        self.method = method
+        self.func = func
+        # 호출할 때마다 시그니처를 분석하지 않도록 미리 생성
+        self.signature = inspect.signature(func)
+        # api 경로의 포멧 형식도 미리 분석, 단순한 {name} 형태만 직접 조합
+        self.path_parts = tuple(string.Formatter().parse(path))
+        self.is_simple_path = all(
+            not spec and not conversion and (name is None or name.isidentifier())
+            for _, name, spec, conversion in self.path_parts
+        )
+        functools.update_wrapper(self, func)
+
+    def __get__(self, instance: Any, owner: type = None) -> callable:
+        if instance is None:
+            return self
+        return types.MethodType(self, instance)
+
+    def __call__(self, instance: Any, *args: tuple, **kwds: dict) -> dict:
+        # return value of an wrapped method
+        api: dict = self.func(instance, *args, **kwds) or {}
+        instance.adjust_api(api)
+        bound = self.signature.bind(instance, *args, **kwds)
+        api_path: str = self.format_path(api.get('format', {}), bound.arguments)
+        params: dict = api.get('params')
+        data: dict = api.get('data')
+        headers: dict = api.get('headers')
+        auth: tuple = api.get('auth')
+        url: str = instance._url_prefix + api_path + instance._url_suffix
+        '''
+        {
+            'status_code': 200,
+            'content': '...',
+            'exception': None,
+            'json': {...},
+            'url': 'https://...',
+        }
+        '''
+        return parse_response(request(
+            self.method,
+            url,
+            params=params,
+            data=data,
+            auth=auth,
+            headers=headers
+        ))
+
+    def format_path(self, format_: dict, arguments: dict) -> str:
+        if not self.is_simple_path:
+            return self.path.format(**format_, **arguments)
+        fields = {**format_, **arguments}
+        return ''.join(literal + (str(fields[name]) if name else '') for literal, name, _, _ in self.path_parts)
+
+
 class Api:
 
-    url = None
+    _url = None
     url_parts = None
 
     def __init__(self, url: str = '') -> None:
         self.url = url.strip().strip('/')
-        self.url_parts = urllib.parse.urlparse(self.url)
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    @url.setter
+    def url(self, url: str) -> None:
+        self._url = url
+        self.url_parts = urllib.parse.urlparse(url)
+        # 요청마다 urlunparse 하지 않도록 api 경로 앞뒤의 문자열을 미리 생성
+        prefix = f'{self.url_parts.scheme}:' if self.url_parts.scheme else ''
+        if self.url_parts.netloc:
+            prefix += f'//{self.url_parts.netloc}'
+        self._url_prefix = prefix + self.url_parts.path.rstrip('/')
+        suffix = f';{self.url_parts.params}' if self.url_parts.params else ''
+        if self.url_parts.query:
+            suffix += f'?{self.url_parts.query}'
+        if self.url_parts.fragment:
+            suffix += f'#{self.url_parts.fragment}'
+        self._url_suffix = suffix
 
     def http_api(path: str, method: str = 'GET') -> callable:
-        def decorator(class_method: callable) -> callable:
-            @functools.wraps(class_method)
-            def wrapper(self, *args: tuple, **kwds: dict) -> dict:
-                """
-                api에 추가적인 데이터가 필요한 경우 딕셔너리 형태로 리턴
-
-                    @Api.http_api('/path/{sub_path}/{extra_path}', method='POST')
-                    def test(self, sub_path: str, param1: str, param2: int, data1: str, data2: str) -> dict:
-                        return {
-                            'params': {
-                                'a': param1,
-                                'b': parma2,
-                            },
-                            'data': {
-                                'c': data1,
-                                'd': data2,
-                            },
-                            'headers': {
-                                'Accept': 'application/json'
-                            },
-                            'auth: ('user', 'password'),
-                            'format': {
-                                'extra_path': 'additonal_path',
-                            }
-                        }
-
-                api에 추가적인 데이터가 필요하지 않은 경우 리턴하지 않음
-
-                    @Api.http_api('/version')
-                    def no_return(self) -> dict:
-                        pass
-
-                api 경로는 python 포멧 형식으로 작성할 수 있고 포멧 키워드는 메소드에서 입력받은 동일한 이름의 파라미터 값으로 대체 됨
-
-                    @Api.http_api('/path/{sub_path}', method='POST')
-                    def test(self, sub_path: str) -> dict:
-                        pass
-
-                    test('login') -> '/path/login'
-
-                혹은 'format' 값을 직접 return 하여 동적으로 api 경로를 생성할 수 있음
-
-                    @Api.http_api('/path/{sub_path}/{extra_path}')
-                    def test(self, sub_path: str) -> dict:
-                        return {
-                            'format': {
-                                'extra_path': 'users',
-                            }
-                        }
-
-                    test('group') -> '/path/group/users'
-                """
-                # return value of an wrapped method
-                api: dict = class_method(self, *args, **kwds) or {}
-                self.adjust_api(api)
-                bound = inspect.signature(class_method).bind(self, *args, **kwds)
-                api_path: str = path.format(**api.get('format', {}), **bound.arguments)
-                params: dict = api.get('params')
-                data: dict = api.get('data')
-                headers: dict = api.get('headers')
-                auth: tuple = api.get('auth')
-                url: str = urllib.parse.urlunparse((
-                    self.url_parts.scheme,
-                    self.url_parts.netloc,
-                    self.url_parts.path + api_path,
-                    self.url_parts.params,
-                    self.url_parts.query,
-                    self.url_parts.fragment
-                ))
-                '''
-                {
-                    'status_code': 200,
-                    'content': '...',
-                    'exception': None,
-                    'json': {...},
-                    'url': 'https://...',
-                }
-                '''
-                return parse_response(request(
-                    method,
-                    url,
-                    params=params,
-                    data=data,
-                    auth=auth,
-                    headers=headers
-                ))
-            return wrapper
+        def decorator(class_method: callable) -> 'HttpApi':
+            return HttpApi(path, method, class_method)
         return decorator
 
     def adjust_api(self, api_data: dict) -> None:
@@ -127,13 +212,25 @@ class GoogleDrive(Api):
     _credentials = None
     _api_drive = None
     _api_activity = None
+    _file_cache = None
+    num_retries = 3
+    # 경로 조회에 필요한 필드만 요청
+    PATH_FIELDS = 'id,name,parents'
 
-    def __init__(self, token: dict, scopes: tuple):
+    def __init__(self, token: dict, scopes: tuple, cache_maxsize: int = None, cache_ttl: int = None):
         super(GoogleDrive, self).__init__()
         self._token = token
         self._scopes = scopes
+        self.cache_maxsize = int(cache_maxsize) if cache_maxsize else 1024
+        self.cache_ttl = int(cache_ttl) if cache_ttl else 600
+        self._file_cache = TTLCache(maxsize=self.cache_maxsize, ttl=self.cache_ttl)
+        self._file_cache_lock = threading.Lock()
+        self._file_flight = SingleFlight()
+        self._get_file_cached = cached(self._file_cache, key=hashkey, lock=self._file_cache_lock)(self._get_file_coalesced)
         self._credentials: credentials.Credentials = credentials.Credentials.from_authorized_user_info(self.token, self.scopes)
-        authorized_http = AuthorizedHttp(self.credentials, http=Http())
+        self._refresh_lock = threading.Lock()
+        self._thread_http = ThreadLocalHttp(self.new_http)
+        authorized_http = self.new_http()
         self._api_drive: Resource = build('drive', 'v3', requestBuilder=self.build_google_request, http=authorized_http)
         self._api_activity: Resource = build('driveactivity', 'v2', requestBuilder=self.build_google_request, http=authorized_http)
 
@@ -159,20 +256,24 @@ class GoogleDrive(Api):
 
     def build_google_request(self, http: AuthorizedHttp, *args, **kwargs):
         # https://googleapis.github.io/google-api-python-client/docs/thread_safety.html
-        new_http = AuthorizedHttp(self.credentials, http=Http())
-        return HttpRequest(new_http, *args, **kwargs)
+        # 요청은 이벤트 루프에서 만들고 실행은 다른 스레드에서 하므로 실행하는 스레드의 연결을 사용
+        return HttpRequest(self._thread_http, *args, **kwargs)
+
+    def new_http(self) -> AuthorizedHttp:
+        return LockedAuthorizedHttp(self.credentials, http=Http(), refresh_lock=self._refresh_lock)
 
     def get_full_path(self, item_id: str, ancestor: str = '') -> tuple:
         if not item_id:
             raise Exception(f'ID를 확인하세요: "{item_id}"')
         ancestor_id, _, root = ancestor.partition('#')
-        file = self.get_file(item_id)
+        # 대상 아이템은 이름이 바뀌었을 수 있으니 항상 새로 조회
+        file = self.get_file(item_id, fields=self.PATH_FIELDS, fresh=True)
         if root and item_id == ancestor_id:
             current_path = [(root, ancestor_id)]
         else:
             current_path = [(file['name'], file['id'])]
             while file.get('parents'):
-                file = self.get_file(file.get('parents')[0])
+                file = self.get_file(file.get('parents')[0], fields=self.PATH_FIELDS)
                 if root and file['id'] == ancestor_id:
                     current_path.append((root, ancestor_id))
                     break
@@ -180,28 +281,39 @@ class GoogleDrive(Api):
                     current_path.append((file['name'], file['id']))
         if len(current_path[-1][1]) < 20:
             current_path[-1] = (f'/{current_path[-1][1]}', current_path[-1][1])
-        full_path = pathlib.Path(*[p[0] for p in current_path[::-1] if p[0]])
+        # pathlib.Path 객체 대신 문자열로 결합
+        names = [p[0] for p in current_path[::-1] if p[0]]
+        full_path = posixpath.join(*names) if names else '.'
         parent = current_path[1] if len(current_path) > 1 else current_path[0]
-        return full_path.as_posix(), parent
+        return full_path, parent
 
-    def get_file(self, item_id: str, fields: str = '*') -> dict:
+    def get_file(self, item_id: str, fields: str = '*', fresh: bool = False) -> dict:
+        if fresh:
+            with self._file_cache_lock:
+                self._file_cache.pop(hashkey(item_id, fields), None)
         try:
-            result = self.api_drive.files().get(
-                fileId=item_id,
-                fields=fields,
-                supportsAllDrives=True,
-            ).execute()
+            result = self._get_file_cached(item_id, fields)
         except:
             logger.error(traceback.format_exc())
             result = {'id': item_id, 'name': None}
         return result
 
+    def _get_file_coalesced(self, item_id: str, fields: str = '*') -> dict:
+        return self._file_flight.do(hashkey(item_id, fields), self._get_file, item_id, fields)
+
+    def _get_file(self, item_id: str, fields: str = '*') -> dict:
+        return self.api_drive.files().get(
+            fileId=item_id,
+            fields=fields,
+            supportsAllDrives=True,
+        ).execute(num_retries=self.num_retries)
+
     def get_files(self, query: str) -> dict:
         result = self.api_drive.files().list(
             q=query,
             supportsAllDrives=True,
             includeItemsFromAllDrives=True,
-        ).execute()
+        ).execute(num_retries=self.num_retries)
         return result
 
 
@@ -222,9 +334,9 @@ class Rclone(Api):
             self.vfs = None
         self.user = url.username
         self.password = url.password
+        self._auth = (self.user, self.password) if self.user and self.password else None
         try:
             self.url = urllib.parse.urlunparse([url.scheme, url.netloc, '', '', '', ''])
-            self.url_parts = urllib.parse.urlparse(self.url)
         except Exception as e:
             logger.error(traceback.format_exc())
             logger.error(f'Rclone: {url=}')
@@ -232,7 +344,7 @@ class Rclone(Api):
 
     def adjust_api(self, api_data: dict) -> None:
         '''override'''
-        api_data['auth'] = (self.user, self.password) if self.user and self.password else None
+        api_data['auth'] = self._auth
 
     @Api.http_api('/vfs/stats', method='JSON')
     def api_vfs_stats(self, fs: str = None) -> dict:
@@ -285,33 +397,46 @@ class Rclone(Api):
         return item.get('IsDir', 'None').lower() == 'true'
 
     def refresh(self, remote_path: str, recursive: bool = False) -> None:
-        target = pathlib.Path(remote_path)
-        result = self.api_vfs_refresh(target.as_posix(), recursive).get('json', {})
-        logger.debug(f'Rclone: {result}')
-        if result.get('result', {}).get(target.as_posix()) == 'OK':
-            return
-        for parent in target.parents:
-            result: dict[str, dict] = self.api_vfs_refresh(parent.as_posix(), recursive).get('json', {})
-            logger.debug(f'Rclone: {result}')
-            if result.get('result', {}).get(parent.as_posix()) == 'OK':
+        target = remote_path.rstrip('/') or '/'
+        # 대상 경로부터 상위로 올라가며 캐시된 경로를 찾고, 찾으면 중단
+        for path_ in (target, *get_parents(target)):
+            status = self.refresh_dir(path_, recursive)
+            if status == 'OK':
+                return
+            if not status:
+                # 경로별 결과가 없으면 요청 자체가 실패한 것이므로 상위 경로도 실패할테니 중단
+                logger.warning('Rclone: Could not refresh "%s": %s', path_, status)
                 return
+            # 캐시에 없는 경로거나 캐시된 파일("invalid argument", "not a directory")이면 상위 경로로
         logger.warning(f'Rclone: It has hit the top-level path.')
 
+    def refresh_dir(self, remote_path: str, recursive: bool = False) -> Optional[str]:
+        result: dict[str, dict] = self.api_vfs_refresh(remote_path, recursive).get('json') or {}
+        logger.debug('Rclone: %s', result)
+        return (result.get('result') or {}).get(remote_path)
+
 
 class Plex(Api):
 
+    HEADERS = types.MappingProxyType({'Accept': 'application/json'})
+
     token = None
 
-    def __init__(self, url: str, token: str) -> None:
+    def __init__(self, url: str, token: str, sections_ttl: int = 300) -> None:
         super(Plex, self).__init__(url)
         self.token = token.strip()
+        self._token_params = {'X-Plex-Token': self.token}
+        self._sections_cache = TTLCache(maxsize=1, ttl=sections_ttl)
+        self._sections_lock = threading.Lock()
 
     def adjust_api(self, api_data: dict) -> None:
         '''override'''
-        if 'params' not in api_data:
-            api_data['params'] = {}
-        api_data['params']['X-Plex-Token'] = self.token
-        api_data['headers'] = {'Accept': 'application/json'}
+        params = api_data.get('params')
+        if params:
+            params.update(self._token_params)
+        else:
+            api_data['params'] = self._token_params
+        api_data['headers'] = self.HEADERS
 
     @Api.http_api('/library/sections/{section}/refresh')
     def api_refresh(self, section: int, path: Optional[str] = None, force: bool = False) -> dict:
@@ -326,62 +451,96 @@ class Plex(Api):
     def api_sections(self) -> dict:
         pass
 
+    def get_sections_index(self) -> list[tuple[tuple[str, ...], int]]:
+        with self._sections_lock:
+            index = self._sections_cache.get('index')
+        if index is None:
+            sections = self.api_sections().get('json') or {}
+            index = []
+            for directory in sections.get('MediaContainer', {}).get('Directory', []):
+                for location in directory.get('Location', []):
+                    index.append((pathlib.PurePosixPath(location['path']).parts, int(directory['key'])))
+            if index:
+                with self._sections_lock:
+                    self._sections_cache['index'] = index
+        return index
+
     def get_section_by_path(self, path: str) -> int:
-        path_ = pathlib.Path(path)
-        sections = self.api_sections().get('json', {})
-        for directory in sections['MediaContainer']['Directory']:
-            for location in directory['Location']:
-                if path_.is_relative_to(location['path']) or \
-                   pathlib.Path(location['path']).is_relative_to(path_):
-                    return int(directory['key'])
+        parts = pathlib.PurePosixPath(path).parts
+        for location, section in self.get_sections_index():
+            if parts[:len(location)] == location or location[:len(parts)] == parts:
+                return section
 
     def scan(self, path: str, force: bool = False, is_directory: bool = True) -> None:
-        scan_target = path if is_directory else pathlib.Path(path).parent.as_posix()
+        scan_target = get_last_dir(path, is_directory)
         section = self.get_section_by_path(scan_target) or -1
-        logger.debug(f'Plex: {scan_target=} {section=}')
+        logger.debug('Plex: scan_target=%r section=%r', scan_target, section)
         self.api_refresh(section, scan_target, force)
 
 
 class Kavita(Api):
 
+    HEADERS = types.MappingProxyType({
+        'Content-Type': 'application/json',
+        'Accept': 'application/json, */*'
+    })
+
     apikey = None
-    token = None
+    _token = None
+    _headers = HEADERS
     refresh_token = None
 
     def __init__(self, url: str, apikey: str) -> None:
         super(Kavita, self).__init__(url)
         self.apikey = apikey.strip()
+        self._auth_lock = threading.Lock()
         self.set_token()
 
+    @property
+    def token(self) -> str:
+        return self._token
+
+    @token.setter
+    def token(self, token: str) -> None:
+        # 토큰이 바뀔 때만 헤더를 새로 생성
+        self._token = token
+        self._headers = {**self.HEADERS, 'Authorization': f'Bearer {token}'} if token else self.HEADERS
+
     def adjust_api(self, api_data: dict) -> None:
         '''override'''
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json, */*'
-        }
-        if self.token:
-            headers['Authorization'] = f'Bearer {self.token}'
-        api_data['headers'] = headers
+        # 인증 요청처럼 헤더를 직접 지정한 경우는 그대로 사용
+        api_data.setdefault('headers', self._headers)
 
     @Api.http_api('/api/Plugin/authenticate', method='POST')
     def api_plugin_authenticate(self) -> dict:
-        return {'params': {'pluginName': 'GDPoller', 'apiKey': self.apikey}}
+        # 만료된 토큰을 인증 요청에 붙이지 않음
+        return {'params': {'pluginName': 'GDPoller', 'apiKey': self.apikey}, 'headers': self.HEADERS}
 
     @Api.http_api('/api/Library/scan-folder', method='JSON')
     def api_library_scan_folder(self, folder: str) -> dict:
         return {'data': {'folderPath': folder, 'apiKey': self.apikey}}
 
-    def set_token(self) -> None:
-        result = self.api_plugin_authenticate()
-        if not 199 < result.get('status_code', 0) < 300:
-            logger.error(f'kavita: {result}')
-        auth = result.get('json', {})
-        self.token = auth.get('token') or ''
-        self.refresh_token = auth.get('refreshToken') or ''
+    def set_token(self, expired: Optional[str] = None) -> None:
+        # 클라이언트를 공유하는 dispatcher들이 동시에 갱신하지 않도록
+        with self._auth_lock:
+            # 기다리는 동안 이미 갱신됐으면 그 토큰을 사용
+            if expired is not None and self.token != expired:
+                return
+            result = self.api_plugin_authenticate()
+            if not 199 < result.get('status_code', 0) < 300:
+                logger.error(f'kavita: {result}')
+            auth = result.get('json') or {}
+            self.token = auth.get('token') or ''
+            self.refresh_token = auth.get('refreshToken') or ''
 
 
 class Discord(Api):
 
+    HEADERS = types.MappingProxyType({
+        'Content-Type': 'application/json',
+        'Accept': 'application/json, */*'
+    })
+
     webhook_id = None
     webhook_token = None
 
@@ -389,19 +548,16 @@ class Discord(Api):
         super(Discord, self).__init__(url)
         self.webhook_id = webhook_id
         self.webhook_token = webhook_token
-
-    def adjust_api(self, api_data: dict) -> None:
-        '''override'''
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json, */*'
-        }
-        api_data['headers'] = headers
-        api_data['format'] = {
+        self._format = {
             'webhook_id': self.webhook_id,
             'webhook_token': self.webhook_token,
         }
 
+    def adjust_api(self, api_data: dict) -> None:
+        '''override'''
+        api_data['headers'] = self.HEADERS
+        api_data['format'] = self._format
+
     @Api.http_api('/webhooks/{webhook_id}/{webhook_token}', method='JSON')
     def api_webhook(self, username: str = 'Activity Poller', content: str = None, embeds: list[dict] = None) -> dict:
         data = {
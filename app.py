@@ -33,6 +33,11 @@ try:
 except:
     subprocess.check_call([sys.executable, *ARGS, 'httplib2'])
 
+try:
+    __import__('cachetools')
+except:
+    subprocess.check_call([sys.executable, *ARGS, 'cachetools'])
+
 import yaml
 
 import dispatchers
@@ -41,6 +46,8 @@ from pollers import ActivityPoller
 from helpers import RedactedFormatter, stop_event_loop
 
 logger = logging.getLogger(__name__)
+# libyaml이 있으면 C 로더를 사용
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 LOCAL_TIMEZONE = datetime.datetime.now(datetime.timezone(datetime.timedelta(0))).astimezone().tzinfo
 
 
@@ -77,12 +84,16 @@ async def async_main(*args: tuple, **kwds: dict) -> None:
             CONFIG_FILE = pathlib.Path(args[1])
         else:
             CONFIG_FILE = pathlib.Path(__file__).with_name('config.yaml')
-        with CONFIG_FILE.open(mode='r', encoding='utf-8') as file:
-            config = yaml.safe_load(file.read())
+        with CONFIG_FILE.open(mode='rb') as file:
+            config = yaml.load(file, Loader=YAML_LOADER)
 
         set_logger(kwds.get('logger'), config['logging']['level'], config['logging']['format'], config['logging']['redacted_patterns'], config['logging']['redacted_substitute'])
 
-        drive = GoogleDrive(config['google_drive']['token'], config['google_drive']['scopes'])
+        drive = GoogleDrive(
+            config['google_drive']['token'],
+            config['google_drive']['scopes'],
+            cache_maxsize=config['google_drive'].get('cache_maxsize'),
+            cache_ttl=config['google_drive'].get('cache_ttl'))
         for poller in config['pollers']:
             dispatcher_list = []
             for dispatcher in poller.get('dispatchers', [{'class': 'DummyDispatcher'}]):
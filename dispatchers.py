@@ -1,19 +1,49 @@
 import logging
-import pathlib
-import threading
 import asyncio
+import functools
+import collections
+from typing import Any
 
 from apis import Rclone, Plex, Kavita, Discord, Flaskfarm
-from helpers import FolderBuffer, parse_mappings, map_path
+from helpers import FolderBuffer, parse_mappings, map_path, await_sync, wait_for_event, get_last_dir
 
 logger = logging.getLogger(__name__)
+MAPPING_CACHE_SIZE = 4096
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_EMBED_CHARS = 6000
+# 버퍼를 비울 때 동시에 처리할 폴더 수, 경로 조회와 같은 executor를 사용하므로 작게 유지
+BUFFERED_CONCURRENCY = 4
+# (action, is_folder): gds_tool scan mode
+GDS_TOOL_SCAN_MODES = {
+    ('create', True): 'ADD',
+    ('create', False): 'ADD',
+    ('move', True): 'ADD',
+    ('move', False): 'ADD',
+    ('delete', True): 'REMOVE_FOLDER',
+    ('delete', False): 'REMOVE_FILE',
+    ('edit', True): 'REFRESH',
+    ('edit', False): 'REFRESH',
+}
+
+# 같은 설정의 API 클라이언트는 dispatcher끼리 공유
+_clients: dict[tuple, Any] = {}
+
+
+def get_client(class_: type, *args) -> Any:
+    key = (class_, *args)
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = class_(*args)
+    return client
 
 
 class Dispatcher:
 
     def __init__(self, mappings: list = None) -> None:
-        self.stop_event = threading.Event()
+        self.stop_event = asyncio.Event()
         self.mappings = parse_mappings(mappings) if mappings else None
+        # 같은 부모 폴더가 반복해서 들어오므로 결과를 기억
+        self._map_path = functools.lru_cache(maxsize=MAPPING_CACHE_SIZE)(functools.partial(map_path, mappings=self.mappings)) if self.mappings else None
 
     async def start(self) -> None:
         if self.stop_event.is_set():
@@ -31,81 +61,138 @@ class Dispatcher:
     async def on_stop(self) -> None:
         pass
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         raise Exception('이 메소드를 구현하세요.')
 
     def get_mapping_path(self, target_path: str) -> str:
-        return map_path(target_path, self.mappings) if self.mappings else target_path
+        return self._map_path(target_path) if self._map_path else target_path
 
 
 class DummyDispatcher(Dispatcher):
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         '''override'''
-        logger.info(f'DummyDispatcher: {data}')
+        logger.info('DummyDispatcher: %s', data)
 
 
-class KavitaDispatcher(Dispatcher):
+class BufferedDispatcher(Dispatcher):
 
-    def __init__(self, url: str = None, apikey: str = None, mappings: list = None) -> None:
-        super(KavitaDispatcher, self).__init__(mappings=mappings)
-        self.kavita = Kavita(url, apikey)
+    def __init__(self, interval: int = 30, mappings: list = None, concurrency: int = BUFFERED_CONCURRENCY) -> None:
+        super(BufferedDispatcher, self).__init__(mappings=mappings)
+        self.interval = interval
+        self.folder_buffer = FolderBuffer()
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def dispatch(self, data: dict) -> None:
+        '''override'''
+        self.folder_buffer.put(data['path'], data['action'], data['is_folder'])
+
+    async def on_start(self) -> None:
+        '''override'''
+        logger.debug(f'{self.__class__.__name__} starts...')
+        while not self.stop_event.is_set():
+            await self.flush()
+            # interval 만큼 기다리되 stop 요청이 오면 바로 종료
+            if await wait_for_event(self.stop_event, self.interval): break
+
+    async def on_stop(self) -> None:
+        '''override'''
+        # stop() 후에 태스크가 바로 취소되므로 남은 항목은 여기서 처리
+        await self.flush()
+
+    async def flush(self) -> None:
+        # 같은 폴더의 항목은 들어온 순서대로, 다른 폴더끼리는 제한된 개수만 동시에 처리
+        groups: dict[str, list] = {}
+        for item in self.folder_buffer.drain().items():
+            groups.setdefault(item[0][1], []).append(item)
+        await asyncio.gather(*(self.flush_group(items) for items in groups.values()))
+
+    async def flush_group(self, items: list[tuple[tuple[str, str], dict]]) -> None:
+        async with self.semaphore:
+            for item in items:
+                try:
+                    await self.buffered_dispatch(item)
+                except Exception as e:
+                    logger.error(f'{self.__class__.__name__}: {item[0]}: {e!r}')
+
+    async def buffered_dispatch(self, item: tuple[tuple[str, str], dict]) -> None:
+        raise Exception('이 메소드를 구현하세요.')
+
+
+class KavitaDispatcher(BufferedDispatcher):
+
+    def __init__(self, url: str = None, apikey: str = None, mappings: list = None, interval: int = 30) -> None:
+        super(KavitaDispatcher, self).__init__(interval=interval, mappings=mappings, concurrency=8)
+        self.kavita = get_client(Kavita, url, apikey)
+        self._in_flight: set[str] = set()
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         '''override'''
-        kavita_path = self.get_mapping_path(data['path'])
-        if not data.get('is_folder'):
-            kavita_path = pathlib.Path(kavita_path).parent.as_posix()
+        # interval 동안 같은 폴더의 activity를 모아서 한번만 스캔
+        self.folder_buffer.put(data['path'], 'scan', data.get('is_folder'))
+
+    async def buffered_dispatch(self, item: tuple[tuple[str, str], dict]) -> None:
+        '''override'''
+        _, folder = item[0]
+        kavita_path = self.get_mapping_path(folder)
+        # 매핑 후 같은 경로가 되는 폴더는 한번만 스캔
+        if kavita_path in self._in_flight:
+            logger.debug('Kavita: already scanning: %s', kavita_path)
+            return
+        self._in_flight.add(kavita_path)
+        try:
+            await await_sync(self.scan_folder, kavita_path)
+        finally:
+            self._in_flight.discard(kavita_path)
+
+    def scan_folder(self, kavita_path: str) -> None:
+        token = self.kavita.token
         result = self.kavita.api_library_scan_folder(kavita_path)
-        logger.info(f'Kavita: scan_target="{kavita_path}" status_code={result.get("status_code", 0)}')
+        logger.info('Kavita: scan_target="%s" status_code=%s', kavita_path, result.get('status_code', 0))
         if result.get('status_code', 0) == 401:
-            self.kavita.set_token()
+            # 동시에 401을 받은 스캔들이 토큰을 한번만 갱신하도록
+            self.kavita.set_token(expired=token)
             result = self.kavita.api_library_scan_folder(kavita_path)
-            logger.info(f'Kavita: scan_target="{kavita_path}" status_code={result.get("status_code", 0)}')
+            logger.info('Kavita: scan_target="%s" status_code=%s', kavita_path, result.get('status_code', 0))
 
 
 class FlaskfarmDispatcher(Dispatcher):
 
     def __init__(self, url: str = None, apikey: str = None, mappings: list = None) -> None:
         super(FlaskfarmDispatcher, self).__init__(mappings=mappings)
-        self.flaskfarm = Flaskfarm(url, apikey)
+        self.flaskfarm = get_client(Flaskfarm, url, apikey)
 
 
 class GDSToolDispatcher(FlaskfarmDispatcher):
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         '''override'''
-        match (data.get('action'), data.get('is_folder')):
-            case 'create' | 'move', _:
-                scan_mode = 'ADD'
-            case 'delete', True:
-                scan_mode = 'REMOVE_FOLDER'
-            case 'delete', False:
-                scan_mode = 'REMOVE_FILE'
-            case 'edit', _:
-                scan_mode = 'REFRESH'
+        scan_mode = GDS_TOOL_SCAN_MODES.get((data.get('action'), bool(data.get('is_folder'))))
+        if not scan_mode:
+            logger.warning('gds_tool: This action is not supported: %s', data.get('action'))
+            return
         gds_path = self.get_mapping_path(data['path'])
-        logger.info(f'gds_tool: mode={scan_mode} target="{gds_path}"')
-        self.flaskfarm.api_gds_tool_fp_broadcast(gds_path, scan_mode)
+        logger.info('gds_tool: mode=%s target="%s"', scan_mode, gds_path)
+        await await_sync(self.flaskfarm.api_gds_tool_fp_broadcast, gds_path, scan_mode)
 
 
 class PlexmateDispatcher(FlaskfarmDispatcher):
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         '''override'''
         target_path = self.get_mapping_path(data['path'])
-        if data['action'] == 'delete':
-            mode = 'REMOVE_FOLDER' if data['is_folder'] else 'REMOVE_FILE'
-        else:
-            mode = 'ADD'
-        logger.info(f'plex_mate: {self.flaskfarm.api_plex_mate_scan_do_scan(target_path, mode=mode)}')
+        remove_mode = 'REMOVE_FOLDER' if data['is_folder'] else 'REMOVE_FILE'
+        mode = remove_mode if data['action'] == 'delete' else 'ADD'
+        # 새 경로와 이전 경로의 스캔 요청은 서로 독립적이므로 동시에 요청, 중복은 한번만
+        scans = {(target_path, mode): None}
         if data.get('removed_path'):
-            mode = 'REMOVE_FOLDER' if data['is_folder'] else 'REMOVE_FILE'
-            removed_path = self.get_mapping_path(data['removed_path'])
-            logger.info(f'plex_mate: {self.flaskfarm.api_plex_mate_scan_do_scan(removed_path, mode=mode)}')
+            scans[self.get_mapping_path(data['removed_path']), remove_mode] = None
+        calls = (await_sync(self.flaskfarm.api_plex_mate_scan_do_scan, path_, mode=mode_) for path_, mode_ in scans)
+        for result in await asyncio.gather(*calls):
+            logger.info('plex_mate: %s', result)
 
 
-class DiscordDispatcher(Dispatcher):
+class DiscordDispatcher(BufferedDispatcher):
 
     colors = {
         'default': '0',
@@ -121,102 +208,154 @@ class DiscordDispatcher(Dispatcher):
             webhook_id: str = None,
             webhook_token: str = None,
             colors: dict = None,
-            mappings: list = None
+            mappings: list = None,
+            interval: int = 10
         ) -> None:
-        super(DiscordDispatcher, self).__init__(mappings=mappings)
+        super(DiscordDispatcher, self).__init__(interval=interval, mappings=mappings)
+        # 클래스 속성을 변경하지 않도록 인스턴스에 복사
+        self.colors = dict(self.colors)
         if colors:
-            for action in colors:
-                self.colors[action] = colors[action]
-        self.discord = Discord(url, webhook_id, webhook_token)
-
-    def dispatch(self, data: dict) -> None:
+            self.colors.update(colors)
+        self._default_color = self.colors['default']
+        # action별 (색상, 설명)
+        self._styles: dict[str, tuple[str, str]] = {}
+        self.discord = get_client(Discord, url, webhook_id, webhook_token)
+        # (embed 글자 수, embed)
+        self.embeds: collections.deque[tuple[int, dict]] = collections.deque()
+
+    async def dispatch(self, data: dict) -> None:
         '''override'''
+        fields = [
+            {'name': 'Path', 'value': data['path']},
+            {'name': 'ID', 'value': data['target'][1]},
+            {'name': 'MIME', 'value': data['target'][2]},
+            {'name': 'Link', 'value': data['url']},
+            {'name': 'Occurred at', 'value': data['timestamp']},
+        ]
+        if data['action'] == 'move':
+            fields.insert(1, {'name': 'From', 'value': data['removed_path'] or 'unknown'})
+        elif data.get('action_detail'):
+            # permissionChange 등은 list로 오기 때문에 문자열로 변환
+            detail = data['action_detail']
+            fields.insert(1, {'name': 'Details', 'value': detail if isinstance(detail, str) else str(detail)})
+        style = self._styles.get(data['action'])
+        if style is None:
+            style = self._styles[data['action']] = (self.colors.get(data['action'], self._default_color), f'# {data["action"].upper()}')
         embed = {
-            'color': self.colors.get(data['action'], self.colors['default']),
+            'color': style[0],
             'author': {
                 'name': data['poller'],
             },
             'title': data['target'][0],
-            'description': f'# {data["action"].upper()}',
-            'fields': []
+            'description': style[1],
+            'fields': fields,
         }
-        embed['fields'].append({'name': 'Path', 'value': data['path']})
-        if data['action'] == 'move':
-            embed['fields'].append({'name': 'From', 'value': data['removed_path'] if data['removed_path'] else f'unknown'})
-        elif data.get('action_detail'):
-            embed['fields'].append({'name': 'Details', 'value': data["action_detail"]})
-        embed['fields'].append({'name': 'ID', 'value': data['target'][1]})
-        embed['fields'].append({'name': 'MIME', 'value': data['target'][2]})
-        embed['fields'].append({'name': 'Link', 'value': data['url']})
-        embed['fields'].append({'name': 'Occurred at', 'value': data['timestamp']})
-        result = self.discord.api_webhook(embeds=[embed])
-        logger.info(f"Discord: target=\"{data['target'][0]}\" status_code={result.get('status_code', 0)}")
+        size = len(embed['title']) + len(embed['description']) + len(embed['author']['name'])
+        size += sum(len(field['name']) + len(str(field['value'])) for field in fields)
+        self.embeds.append((size, embed))
+
+    async def flush(self) -> None:
+        '''override'''
+        # 웹훅 한번에 embed 10개, 합계 6000자까지 전송 가능
+        while self.embeds:
+            batch = []
+            total = 0
+            while self.embeds and len(batch) < DISCORD_MAX_EMBEDS:
+                size = self.embeds[0][0]
+                if batch and total + size > DISCORD_MAX_EMBED_CHARS:
+                    break
+                batch.append(self.embeds.popleft())
+                total += size
+            status_code = await self.send_embeds([embed for _, embed in batch])
+            if status_code == 429:
+                # 요청할 때 이미 재시도 했으므로 다음 interval에 다시 전송
+                self.embeds.extendleft(reversed(batch))
+                logger.warning('Discord: rate limited, %d embeds are left for the next flush', len(self.embeds))
+                return
+            if status_code == 400 and len(batch) > 1:
+                # 잘못된 embed 하나 때문에 나머지가 버려지지 않도록 하나씩 다시 전송
+                for index, (_, embed) in enumerate(batch):
+                    status_code = await self.send_embeds([embed])
+                    if status_code == 429:
+                        self.embeds.extendleft(reversed(batch[index:]))
+                        logger.warning('Discord: rate limited, %d embeds are left for the next flush', len(self.embeds))
+                        return
+                    if status_code != 400 and not 199 < status_code < 300:
+                        logger.error('Discord: %d embeds are dropped: status_code=%s', len(batch) - index, status_code)
+                        break
+            elif not 199 < status_code < 300:
+                logger.error('Discord: %d embeds are dropped: status_code=%s', len(batch), status_code)
+
+    async def send_embeds(self, embeds: list[dict]) -> int:
+        result = await await_sync(self.discord.api_webhook, embeds=embeds)
+        status_code = result.get('status_code', 0)
+        logger.info('Discord: embeds=%d status_code=%s', len(embeds), status_code)
+        return status_code
 
 
 class RcloneDispatcher(Dispatcher):
 
     def __init__(self, url: str = None, mappings: list = None) -> None:
         super(RcloneDispatcher, self).__init__(mappings=mappings)
-        self.rclone = Rclone(url)
+        self.rclone = get_client(Rclone, url)
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         '''override'''
         if data.get('action', '') == 'delete':
-            self.rclone.api_vfs_forget(data['path'], data['is_folder'])
+            await await_sync(self.rclone.api_vfs_forget, data['path'], data['is_folder'])
             return
+        # 새 경로 갱신과 이전 경로 forget은 서로 독립적이므로 동시에 요청
         remote_path = self.get_mapping_path(data['path'])
-        self.rclone.refresh(remote_path)
+        calls = [await_sync(self.rclone.refresh, remote_path)]
         if data.get('removed_path'):
-            self.rclone.api_vfs_forget(data['removed_path'], data['is_folder'])
+            calls.append(await_sync(self.rclone.api_vfs_forget, data['removed_path'], data['is_folder']))
+        await asyncio.gather(*calls)
 
 
 class PlexDispatcher(Dispatcher):
 
     def __init__(self, url: str = None, token: str = None, mappings: list = None) -> None:
         super(PlexDispatcher, self).__init__(mappings=mappings)
-        self.plex = Plex(url, token)
+        self.plex = get_client(Plex, url, token)
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         '''override'''
-        plex_path = self.get_mapping_path(data['path'])
-        self.plex.scan(plex_path, is_directory=data['is_folder'])
+        # 스캔은 폴더 단위이므로 같은 폴더가 나오면 한번만 스캔
+        scan_dirs = {get_last_dir(self.get_mapping_path(data['path']), data['is_folder']): None}
         if data.get('removed_path'):
-            plex_path = self.get_mapping_path(data['removed_path'])
-            self.plex.scan(plex_path, is_directory=data.get('is_folder'))
+            scan_dirs[get_last_dir(self.get_mapping_path(data['removed_path']), data['is_folder'])] = None
+        await asyncio.gather(*(await_sync(self.plex.scan, scan_dir, is_directory=True) for scan_dir in scan_dirs))
 
 
-class PlexRcloneDispatcher(RcloneDispatcher):
+class PlexRcloneDispatcher(BufferedDispatcher):
 
     def __init__(self, url: str = None, mappings: list = None, plex_url: str = None, plex_token: str = None, interval: int = 30, plex_mappings: list = None) -> None:
-        super(PlexRcloneDispatcher, self).__init__(url=url, mappings=mappings)
-        self.plex = Plex(plex_url, plex_token)
+        super(PlexRcloneDispatcher, self).__init__(interval=interval, mappings=mappings)
+        self.rclone = get_client(Rclone, url)
+        self.plex = get_client(Plex, plex_url, plex_token)
         self.plex_mappings = parse_mappings(plex_mappings) if plex_mappings else None
-        self.interval = interval
-        self.folder_buffer = FolderBuffer()
+        self._map_plex_path = functools.lru_cache(maxsize=MAPPING_CACHE_SIZE)(functools.partial(map_path, mappings=self.plex_mappings)) if self.plex_mappings else None
 
-    def dispatch(self, data: dict) -> None:
+    async def dispatch(self, data: dict) -> None:
         '''override'''
-        self.folder_buffer.put(data['path'], data['action'], data['is_folder'])
+        await super(PlexRcloneDispatcher, self).dispatch(data)
         if data.get('removed_path'):
             self.folder_buffer.put(data['removed_path'], 'delete', data['is_folder'])
 
-    async def on_start(self) -> None:
+    async def buffered_dispatch(self, item: tuple[tuple[str, str], dict]) -> None:
         '''override'''
-        logger.debug(f'PlexRcloneDispatcher starts...')
-        while not self.stop_event.is_set():
-            while len(self.folder_buffer) > 0:
-                item: tuple[str, dict] = self.folder_buffer.pop()
-                logger.debug(item)
-                action, _, parent = item[0].partition('|')
-                match action:
-                    case 'delete':
-                        result = self.rclone.api_vfs_forget(parent, True).get('json', {})
-                        logger.info(f'Rclone: {result}')
-                    case _:
-                        remote_path = self.get_mapping_path(parent)
-                        self.rclone.refresh(remote_path)
-                plex_path = map_path(parent, self.plex_mappings) if self.plex_mappings else parent
-                self.plex.scan(plex_path)
-            for _ in range(self.interval):
-                await asyncio.sleep(1)
-                if self.stop_event.is_set(): break
+        logger.debug(item)
+        action, parent = item[0]
+        # 폴더 안에서는 rclone 갱신 후 plex 스캔 순서를 유지
+        await await_sync(self.refresh_and_scan, action, parent)
+
+    def refresh_and_scan(self, action: str, parent: str) -> None:
+        match action:
+            case 'delete':
+                result = self.rclone.api_vfs_forget(parent, True).get('json', {})
+                logger.info('Rclone: %s', result)
+            case _:
+                remote_path = self.get_mapping_path(parent)
+                self.rclone.refresh(remote_path)
+        plex_path = self._map_plex_path(parent) if self._map_plex_path else parent
+        self.plex.scan(plex_path)
@@ -1,21 +1,35 @@
 import traceback
 import logging
 import re
+import time
+import random
+import fnmatch
 import asyncio
 import functools
-import pathlib
+import threading
+from collections import defaultdict
 from dataclasses import dataclass, field
-from typing import Any, Optional, Union, Iterable
-from collections import OrderedDict
+from typing import Any, Optional, Union, Iterable, Hashable
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from json import loads as json_loads, dumps as json_dumps
 
 logger = logging.getLogger(__name__)
 
+# 같은 호스트에 대한 연결을 재사용
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
 
 class RedactedFormatter(logging.Formatter):
 
-    def __init__(self, *args, patterns: Iterable = [], substitute: str = '<REDACTED>', **kwds):
+    def __init__(self, *args, patterns: Iterable = (), substitute: str = '<REDACTED>', **kwds):
         super(RedactedFormatter, self).__init__(*args, **kwds)
         self.patterns = []
         self.substitute = substitute
@@ -32,76 +46,192 @@ class RedactedFormatter(logging.Formatter):
                 else:
                     groups = [match.group(0)]
                 for found in groups:
-                    msg = self.redact(re.compile(found), msg)
+                    # 찾은 문자열은 정규식이 아니므로 그대로 치환
+                    if found:
+                        msg = self.redact(found, msg)
         return msg
 
-    def redact(self, pattern: re.Pattern, text: str) -> str:
-        return pattern.sub(self.substitute, text)
+    def redact(self, found: str, text: str) -> str:
+        return text.replace(found, self.substitute)
 
 
 class FolderBuffer:
 
     def __init__(self) -> None:
-        self.buffer = OrderedDict()
+        # defaultdict도 입력 순서를 유지하므로 FIFO로 사용
+        self.buffer: defaultdict[tuple[str, str], dict] = defaultdict(lambda: {'children': set()})
 
     def put(self, path: str, action: str = 'create', is_directory: bool = False) -> None:
-        target = pathlib.Path(path)
-        parent = target.as_posix() if is_directory else target.parent.as_posix()
-        key = f'{action}|{parent}'
-        if key in self.buffer:
-            children: set[str] = self.buffer[key]['children']
-            children.add(target.name)
-        else:
-            self.buffer[key] = {
-                'children': set([target.name]),
-            }
-
-    def pop(self) -> tuple[str, dict]:
+        # pathlib.Path 객체를 만들지 않고 문자열로 상위 폴더와 이름을 분리
+        name = path.rstrip('/').rpartition('/')[2]
+        parent = (path.rstrip('/') or '/') if is_directory else get_last_dir(path)
+        # (action, 부모 폴더)를 키로 사용해서 꺼낼 때 다시 분리하지 않음
+        self.buffer[action, parent]['children'].add(name)
+
+    def drain(self) -> dict[tuple[str, str], dict]:
+        # 버퍼를 통째로 교체해서 쌓인 항목을 한번에 반환
+        buffer, self.buffer = self.buffer, defaultdict(self.buffer.default_factory)
+        return buffer
+
+    def pop(self) -> tuple[tuple[str, str], dict]:
         if self.buffer:
-            return self.buffer.popitem(last=False)
+            key = next(iter(self.buffer))
+            return key, self.buffer.pop(key)
 
     def __len__(self) -> int:
         return len(self.buffer)
 
-    def __getitem__(self, key: str) -> dict:
+    def __getitem__(self, key: tuple[str, str]) -> dict:
         return self.buffer.get(key)
 
 
-@dataclass(order=True)
+class RateLimiter:
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._last = 0.0
+
+    def get_wait(self) -> float:
+        return max(self._last + self.interval - time.monotonic(), 0.0)
+
+    async def acquire_async(self) -> None:
+        wait = self.get_wait()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last = time.monotonic()
+
+
+class SingleFlight:
+
+    def __init__(self, timeout: float = 30) -> None:
+        self.timeout = timeout
+        self._calls: dict[Hashable, tuple[threading.Event, list]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: callable, *args, **kwds) -> Any:
+        # 같은 키로 진행중인 호출이 있으면 그 결과를 공유
+        with self._lock:
+            call = self._calls.get(key)
+            is_owner = call is None
+            if is_owner:
+                call = self._calls[key] = (threading.Event(), [None, None])
+        event, slot = call
+        if not is_owner:
+            if not event.wait(self.timeout):
+                # 진행중인 호출이 재시도 등으로 오래 걸리면 실패로 처리하지 않고 직접 호출
+                logger.warning(f'Timed out waiting for the call in flight, calling it directly: {key}')
+                return func(*args, **kwds)
+            if slot[1]:
+                raise slot[1]
+            return slot[0]
+        try:
+            slot[0] = func(*args, **kwds)
+        except Exception as e:
+            slot[1] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            event.set()
+        return slot[0]
+
+
+@dataclass(slots=True)
 class PrioritizedItem:
     priority: float
     item: Any=field(compare=False)
 
+    # order=True는 비교할 때마다 튜플을 만들어서 비교하므로 직접 비교
+    def __lt__(self, other: 'PrioritizedItem') -> bool:
+        return self.priority < other.priority
 
-def request(method: str, url: str, data: Optional[dict] = None, timeout: Union[int, tuple, None] = None, **kwds: dict) -> requests.Response:
-    try:
-        if method.upper() == 'JSON':
-            response = requests.request('POST', url, json=data or {}, timeout=timeout, **kwds)
-        else:
-            response = requests.request(method, url, data=data, timeout=timeout, **kwds)
-        return response
-    except:
-        tb = traceback.format_exc()
-        logger.error(tb)
-        response = requests.Response()
-        response._content = bytes(tb, 'utf-8')
-        response.status_code = 0
-        return response
+    def __le__(self, other: 'PrioritizedItem') -> bool:
+        return self.priority <= other.priority
+
+    def __gt__(self, other: 'PrioritizedItem') -> bool:
+        return self.priority > other.priority
+
+    def __ge__(self, other: 'PrioritizedItem') -> bool:
+        return self.priority >= other.priority
+
+
+class GlobPatterns:
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        # pathlib.PurePosixPath.match 와 같은 규칙, 부분마다 fnmatch 정규식을 미리 컴파일
+        self.patterns: list[tuple[bool, tuple[callable]]] = []
+        for pattern in patterns:
+            parts = split_path(pattern)
+            if not parts:
+                raise ValueError('empty pattern')
+            matchers = tuple(re.compile(fnmatch.translate(part)).match for part in reversed(parts))
+            self.patterns.append((bool(get_root(pattern)), matchers))
+
+    def match(self, path_: str) -> bool:
+        parts = split_path(path_)[::-1]
+        if not parts:
+            return False
+        for is_absolute, matchers in self.patterns:
+            # 절대 경로 패턴은 전체 일치, 상대 경로 패턴은 오른쪽부터 일치
+            if len(matchers) > len(parts) or (is_absolute and len(matchers) != len(parts)):
+                continue
+            if all(matcher(part) for matcher, part in zip(matchers, parts)):
+                return True
+        return False
+
+
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+
+def request(method: str, url: str, data: Optional[dict] = None, timeout: Union[int, tuple, None] = None,
+            retries: int = 3, backoff: float = 0.5, max_backoff: float = 8.0, **kwds: dict) -> requests.Response:
+    is_json = method.upper() == 'JSON'
+    if is_json:
+        # 재시도 때마다 다시 직렬화하지 않도록 미리 변환
+        body = json_dumps(data or {})
+        kwds['headers'] = {'Content-Type': 'application/json', **(kwds.get('headers') or {})}
+    for attempt in range(retries + 1):
+        try:
+            if is_json:
+                response = SESSION.request('POST', url, data=body, timeout=timeout, **kwds)
+            else:
+                response = SESSION.request(method, url, data=data, timeout=timeout, **kwds)
+        except:
+            tb = traceback.format_exc()
+            logger.error(tb)
+            response = requests.Response()
+            response._content = bytes(tb, 'utf-8')
+            response.status_code = 0
+            return response
+        if attempt >= retries or not is_retryable(response):
+            return response
+        wait = get_retry_wait(response, attempt, backoff, max_backoff)
+        logger.warning(f'Retry in {wait:.2f} seconds: status_code={response.status_code} url={response.url}')
+        time.sleep(wait)
+
+
+def is_retryable(response: requests.Response) -> bool:
+    if response.status_code in RETRY_STATUS_CODES:
+        return True
+    if response.status_code == 403:
+        # 구글 API는 할당량 초과를 403으로 응답
+        text = response.text.lower().replace(' ', '')
+        return 'ratelimit' in text or 'quota' in text
+    return False
+
+
+def get_retry_wait(response: requests.Response, attempt: int, backoff: float = 0.5, max_backoff: float = 8.0) -> float:
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(float(retry_after), 60.0)
+        except ValueError:
+            pass
+    return min(max_backoff, backoff * 2 ** attempt) * (0.5 + random.random())
 
 
 async def request_async(method: str, url: str, data: Optional[dict] = None, timeout: Union[int, tuple, None] = None, **kwds: dict) -> requests.Response:
-    try:
-        if method.upper() == 'JSON':
-            return await await_sync(requests.request, 'POST', url, json=data or {}, timeout=timeout, **kwds)
-        else:
-            return await await_sync(requests.request, method, url, data=data, timeout=timeout, **kwds)
-    except:
-        tb = traceback.format_exc()
-        logger.error(tb)
-        response = requests.Response()
-        response._content = bytes(tb, 'utf-8')
-        response.status_code = 0
-        return response
+    return await await_sync(request, method, url, data=data, timeout=timeout, **kwds)
 
 
 def parse_response(response: requests.Response) -> dict[str, Any]:
@@ -112,15 +242,18 @@ def parse_response(response: requests.Response) -> dict[str, Any]:
         'json': None,
         'url': response.url,
     }
-    try:
-        result['json'] = response.json()
-    except Exception as e:
-        result['exception'] = repr(e)
+    if response.content:
+        try:
+            result['json'] = json_loads(response.content)
+        except Exception as e:
+            result['exception'] = repr(e)
     return result
 
 
 def parse_mappings(mappings: Iterable[str]) -> list[tuple[str]]:
-    return [tuple(mapping.split(':')) for mapping in mappings]
+    # 바뀌는 게 없는 매핑은 제외
+    mappings = [tuple(mapping.split(':')) for mapping in mappings]
+    return [mapping for mapping in mappings if mapping[0] and mapping[0] != mapping[1]]
 
 
 def map_path(target: str, mappings: Iterable[Iterable[str]]) -> str:
@@ -135,9 +268,51 @@ async def stop_event_loop() -> None:
     loop.close()
 
 
+async def wait_for_event(event: asyncio.Event, timeout: float) -> bool:
+    try:
+        await asyncio.wait_for(event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    return event.is_set()
+
+
 async def await_sync(func: callable, *args, **kwds) -> Any:
     return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwds))
 
 
+def compile_glob_patterns(patterns: Iterable[str]) -> Optional[GlobPatterns]:
+    patterns = list(patterns)
+    return GlobPatterns(patterns) if patterns else None
+
+
+def split_path(path_: str) -> tuple[str]:
+    # pathlib.PurePosixPath(path_).parts 와 같은 결과
+    root = get_root(path_)
+    segments = tuple(segment for segment in path_.split('/') if segment and segment != '.')
+    return (root, *segments) if root else segments
+
+
+def get_root(path_: str) -> str:
+    # POSIX에서 '/'가 정확히 두 개로 시작하면 별도의 루트
+    if path_.startswith('//') and not path_.startswith('///'):
+        return '//'
+    return '/' if path_.startswith('/') else ''
+
+
 def get_last_dir(path_: str, is_dir: bool = False) -> str:
-    return path_ if is_dir else pathlib.Path(path_).parent.as_posix()
+    if is_dir:
+        return path_
+    head, sep, _ = path_.rstrip('/').rpartition('/')
+    if sep:
+        return head or '/'
+    return '/' if path_.startswith('/') else '.'
+
+
+def get_parents(path_: str) -> list[str]:
+    # pathlib.PurePosixPath(path_).parents 와 같은 순서의 문자열 목록
+    root = '/' if path_.startswith('/') else ''
+    segments = [segment for segment in path_.split('/') if segment and segment != '.']
+    parents = [root + '/'.join(segments[:index]) for index in range(len(segments) - 1, 0, -1)]
+    if segments:
+        parents.append(root or '.')
+    return parents
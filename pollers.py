@@ -1,19 +1,35 @@
-import queue
-import pathlib
+import sys
 import logging
 import traceback
 import datetime
+import time
 import asyncio
-from typing import Any, Iterable
+import functools
+from typing import Any, Iterable, Optional
 
 import dispatchers
 from apis import GoogleDrive
-from helpers import await_sync, PrioritizedItem
+from helpers import await_sync, wait_for_event, compile_glob_patterns, GlobPatterns, PrioritizedItem, RateLimiter
 
 LOCAL_TIMEZONE = datetime.datetime.now(datetime.timezone(datetime.timedelta(0))).astimezone().tzinfo
+# 폴링 하나에서 동시에 조회할 경로 수
+LOOKUP_CONCURRENCY = 5
+FOLDER_MIME_TYPES = frozenset((
+    'application/vnd.google-apps.folder',
+    'application/vnd.google-apps.shortcut',
+))
+# driveItem, drive, fileComment 순서로 대상 정보를 찾음
+TARGET_KEYS = ('driveItem', 'drive', 'fileComment')
+EMPTY_DICT = {}
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=256)
+def format_timestamp(epoch: int) -> str:
+    # 출력 형식에 초 이하가 없으므로 초 단위로 캐시
+    return datetime.datetime.fromtimestamp(epoch, LOCAL_TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S%z')
+
+
 class GoogleDrivePoller:
 
     def __init__(self, drive: GoogleDrive, targets: list[str], dispatcher_list: list[dispatchers.Dispatcher] = None, name: str = None,
@@ -34,6 +50,8 @@ class GoogleDrivePoller:
         self._stop_event = asyncio.Event()
         self._dispatch_queue = None
         self._tasks = None
+        self._lookup_semaphore = asyncio.Semaphore(LOOKUP_CONCURRENCY)
+        self._lookups: set[asyncio.Task] = set()
 
     @property
     def drive(self) -> GoogleDrive:
@@ -108,6 +126,8 @@ class GoogleDrivePoller:
             'settingsChange',
             'appliedLabelChange'
         )
+        # 포함 여부 확인용
+        self._actions_set = frozenset(self._actions)
 
     @property
     def patterns(self) -> list:
@@ -116,6 +136,7 @@ class GoogleDrivePoller:
     @patterns.setter
     def patterns(self, patterns: list) -> None:
         self._patterns = list(patterns) if patterns else ['*']
+        self._patterns_matcher = compile_glob_patterns(self._patterns)
 
     @property
     def ignore_patterns(self) -> list:
@@ -124,6 +145,7 @@ class GoogleDrivePoller:
     @ignore_patterns.setter
     def ignore_patterns(self, ignore_patterns: list) -> None:
         self._ignore_patterns = list(ignore_patterns) if ignore_patterns else []
+        self._ignore_patterns_matcher = compile_glob_patterns(self._ignore_patterns)
 
     @property
     def dispatch_interval(self) -> int:
@@ -132,6 +154,7 @@ class GoogleDrivePoller:
     @dispatch_interval.setter
     def dispatch_interval(self, dispatch_interval: int) -> None:
         self._dispatch_interval = int(dispatch_interval) if dispatch_interval else 1
+        self._dispatch_limiter = RateLimiter(self._dispatch_interval)
 
     @property
     def ignore_folder(self) -> bool:
@@ -146,7 +169,7 @@ class GoogleDrivePoller:
         return self._stop_event
 
     @property
-    def dispatch_queue(self) -> queue.PriorityQueue:
+    def dispatch_queue(self) -> asyncio.PriorityQueue:
         return self._dispatch_queue
 
     @property
@@ -154,7 +177,7 @@ class GoogleDrivePoller:
         return self._tasks
 
     async def start(self) -> None:
-        self._dispatch_queue = queue.PriorityQueue()
+        self._dispatch_queue = asyncio.PriorityQueue()
         self._tasks = []
         if self.stop_event.is_set():
             self.stop_event.clear()
@@ -177,15 +200,15 @@ class GoogleDrivePoller:
             if not task.done():
                 task.print_stack()
                 task.cancel()
+        # 미리 시작한 경로 조회도 취소
+        for lookup in tuple(self._lookups):
+            lookup.cancel()
         self._dispatch_queue = None
         self._tasks = None
 
-    def check_patterns(self, path: str, patterns: list) -> bool:
-        test = pathlib.Path(path)
-        for pattern in patterns:
-            if test.match(pattern):
-                return True
-        return False
+    def check_patterns(self, path: str, matcher: Optional[GlobPatterns]) -> bool:
+        # 미리 컴파일한 패턴들로 한번에 확인
+        return bool(matcher and matcher.match(path))
 
     async def poll(self, target: Any) -> None:
         raise Exception('이 메소드를 구현하세요.')
@@ -202,34 +225,17 @@ class ActivityPoller(GoogleDrivePoller):
 
     async def dispatch(self) -> None:
         logger.info(f'Dispatching task starts: {self.name}')
-        while not self.stop_event.is_set():
-            while not self.dispatch_queue.empty():
+        # stop()에서 큐를 None으로 바꾼 뒤에 태스크가 취소되므로 참조를 유지
+        dispatch_queue = self.dispatch_queue
+        try:
+            while not self.stop_event.is_set():
                 data = None
                 try:
-                    data = self.dispatch_queue.get().item
-                    # action 필터링
-                    if data['action'] not in self.actions:
-                        logger.debug(f'Skip: target={data["target"]} reason={data["action"]}')
-                        continue
-                    # 폴더 타입 확인
-                    if data['target'][2] in [
-                            'application/vnd.google-apps.folder',
-                            'application/vnd.google-apps.shortcut'
-                            ]:
-                        data['is_folder'] = True
-                    else:
-                        data['is_folder'] = False
-                    # 폴더 무시 판단
-                    if self.ignore_folder and data['is_folder']:
-                        logger.debug(f'Skip: target={data["target"]} reason=folder')
-                        continue
-                    # 대상이 영구히 삭제돼서 조회 불가능 할 경우
-                    if data['action'] == 'delete' and data['action_detail'] != 'TRASH':
-                        logger.debug(f'Skip: target={data["target"]} reason="deleted permanently"')
-                        continue
-                    # 대상 경로
+                    # 큐에 아이템이 들어올 때까지 대기, stop()에서 태스크가 취소됨
+                    data, lookup = (await dispatch_queue.get()).item
+                    # 큐에 넣을 때 시작한 경로 조회 결과
+                    data['path'], parent = await lookup
                     target_id = data['target'][1].partition('/')[-1]
-                    data['path'], parent = self.drive.get_full_path(target_id, data.get('ancestor'))
                     if not parent[0]:
                         logger.warning(f"Could not figure out its path: id={target_id} ancestor={data.get('ancestor')} parent={parent[0]}")
                         data['path'] = f"/unknown/{data['target'][0]}"
@@ -240,41 +246,29 @@ class ActivityPoller(GoogleDrivePoller):
                         url_folder_id = parent[1]
                     data['url'] = f'https://drive.google.com/drive/folders/{url_folder_id}'
                     # 패턴 체크
-                    if not self.check_patterns(data['path'], self.patterns):
-                        logger.debug(f'Skip: target={data["target"]} reason="Not match with patterns"')
+                    if not self.check_patterns(data['path'], self._patterns_matcher):
+                        logger.debug('Skip: target=%s reason="Not match with patterns"', data['target'])
                         continue
-                    if self.check_patterns(data['path'], self.ignore_patterns):
-                        logger.debug(f'Skip: target={data["target"]} reason="Match with ignore patterns"')
+                    if self.check_patterns(data['path'], self._ignore_patterns_matcher):
+                        logger.debug('Skip: target=%s reason="Match with ignore patterns"', data['target'])
                         continue
-                    # move일 경우 소스 경로
-                    data['removed_path'] = None
-                    if data['action'] == 'move' and data['action_detail']:
-                        logger.debug(f'Moved from: {data["action_detail"]}')
-                        try:
-                            removed_parent_id = data['action_detail'][1].partition('/')[-1]
-                            removed_path, _ = self.drive.get_full_path(removed_parent_id, data.get('ancestor'))
-                            data['removed_path'] = pathlib.Path(removed_path, data['target'][0]).as_posix()
-                        except Exception as e:
-                            logger.error(traceback.format_exc())
+                    data['removed_path'] = await self.lookup_removed_path(data)
                     # 기타 정보
-                    data['timestamp'] = data['timestamp'].astimezone(LOCAL_TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S%z')
+                    data['timestamp'] = format_timestamp(int(data['timestamp'].replace(microsecond=0).timestamp()))
                     data['poller'] = self.name
+                    # 이전 dispatch 후 dispatch_interval 만큼 경과했는지 확인
+                    await self._dispatch_limiter.acquire_async()
                     for dispatcher in self.dispatcher_list:
                         # activity 발생 순서대로, dispatcher 배치 순서대로
-                        dispatcher.dispatch(data)
+                        await dispatcher.dispatch(data)
                 except Exception as e:
                     logger.error(traceback.format_exc())
                     logger.error(f'{data=}')
                 finally:
                     if data:
-                        self.dispatch_queue.task_done()
-                # 큐에서 각 아이템을 꺼낸 후 sleep
-                for _ in range(self.dispatch_interval):
-                    await asyncio.sleep(1)
-                    if self.stop_event.is_set(): break
-            # 큐에서 아이템을 모두 꺼낸 후 sleep
-            await asyncio.sleep(1)
-        logger.info(f'Dispatching task ends: {self.name}')
+                        dispatch_queue.task_done()
+        finally:
+            logger.info(f'Dispatching task ends: {self.name}')
 
     async def poll(self, ancestor: str) -> None:
         ancestor_id, _, _ = ancestor.partition('#')
@@ -283,6 +277,8 @@ class ActivityPoller(GoogleDrivePoller):
         last_activity_timestamp = datetime.datetime.now().astimezone(datetime.timezone.utc)
         logger.info(f'Polling task starts: {ancestor}')
         while not self.stop_event.is_set():
+            # 조회에 걸린 시간과 상관없이 polling_interval 주기를 유지
+            deadline = time.monotonic() + self.polling_interval
             while not self.stop_event.is_set():
                 try:
                     query = self.drive.api_activity.activity().query(body={
@@ -292,7 +288,7 @@ class ActivityPoller(GoogleDrivePoller):
                         'filter': f'time > "{last_activity_timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")}"',
                     })
                     try:
-                        results = await await_sync(query.execute)
+                        results = await await_sync(query.execute, num_retries=self.drive.num_retries)
                     except Exception as e:
                         logger.error(traceback.format_exc())
                         logger.error(f'Polling failed: {ancestor=}')
@@ -313,21 +309,107 @@ class ActivityPoller(GoogleDrivePoller):
                         data['timestamp'] = datetime.datetime.strptime(timestamp, timestmap_format)
                         if data['timestamp'] > last_activity_timestamp:
                             last_activity_timestamp = data['timestamp']
-                        data['action'], data['action_detail'] = self.getActionInfo(activity['primaryActionDetail'])
-                        data['target'] = next(map(self.getTargetInfo, activity['targets']))
-                        logger.debug(f"{data['action']}, {data['target']}")
-                        self.dispatch_queue.put(PrioritizedItem(data['timestamp'].timestamp(), data))
+                        action, data['action_detail'] = self.getActionInfo(activity['primaryActionDetail'])
+                        # 몇 종류 안되는 문자열이므로 하나의 객체를 공유
+                        data['action'] = sys.intern(action)
+                        data['target'] = self.getTargetInfo(activity['targets'][0])
+                        logger.debug('%s, %s', data['action'], data['target'])
+                        if not self.is_dispatchable(data):
+                            continue
+                        # dispatch 차례가 오기 전에 경로 조회를 미리 시작
+                        self.dispatch_queue.put_nowait(PrioritizedItem(data['timestamp'].timestamp(), (data, self.lookup_path(data))))
                     if not next_page_token:
                         break
                 except Exception as e:
                     logger.error(traceback.format_exc())
                     logger.error(f'{ancestor=}')
                     break
-            for _ in range(self.polling_interval):
-                await asyncio.sleep(1)
-                if self.stop_event.is_set(): break
+            # 남은 시간 동안 기다리되 stop 요청이 오면 바로 종료
+            await wait_for_event(self.stop_event, max(deadline - time.monotonic(), 0))
         logger.info(f'Polling task ends: {ancestor}')
 
+    def is_dispatchable(self, data: dict) -> bool:
+        # action 필터링
+        if data['action'] not in self._actions_set:
+            logger.debug('Skip: target=%s reason=%s', data['target'], data['action'])
+            return False
+        # 폴더 타입 확인
+        data['is_folder'] = data['target'][2] in FOLDER_MIME_TYPES
+        # 폴더 무시 판단
+        if self.ignore_folder and data['is_folder']:
+            logger.debug('Skip: target=%s reason=folder', data['target'])
+            return False
+        # 대상이 영구히 삭제돼서 조회 불가능 할 경우
+        if data['action'] == 'delete' and data['action_detail'] != 'TRASH':
+            logger.debug('Skip: target=%s reason="deleted permanently"', data['target'])
+            return False
+        return True
+
+    async def get_full_path(self, item_id: str, ancestor: str) -> tuple:
+        # 경로 조회가 executor와 API 할당량을 독점하지 않도록 동시에 조회하는 개수를 제한
+        async with self._lookup_semaphore:
+            return await await_sync(self.drive.get_full_path, item_id, ancestor)
+
+    def lookup_path(self, data: dict) -> asyncio.Task:
+        # 대상 경로만 미리 조회, move의 소스 경로는 패턴 확인을 통과한 후에 조회
+        target_id = data['target'][1].partition('/')[-1]
+        task = asyncio.create_task(self.get_full_path(target_id, data.get('ancestor')))
+        # stop()에서 취소할 수 있도록 보관
+        self._lookups.add(task)
+        task.add_done_callback(self._lookups.discard)
+        return task
+
+    async def lookup_removed_path(self, data: dict) -> Optional[str]:
+        if not (data['action'] == 'move' and data['action_detail']):
+            return None
+        logger.debug('Moved from: %s', data['action_detail'])
+        try:
+            removed_parent_id = data['action_detail'][1].partition('/')[-1]
+            removed_path, _ = await self.get_full_path(removed_parent_id, data.get('ancestor'))
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            return None
+        # 경로 객체를 만들지 않고 문자열로 결합
+        if removed_path == '.':
+            return data['target'][0]
+        return f"{removed_path.rstrip('/')}/{data['target'][0]}"
+
+    def _get_create_detail(self, detail: dict) -> str:
+        return self.getOneOf(detail)
+
+    def _get_move_detail(self, detail: dict) -> Optional[tuple]:
+        return self.getTargetInfo(detail['removedParents'][0]) if detail.get('removedParents') else None
+
+    def _get_rename_detail(self, detail: dict) -> Optional[str]:
+        return detail.get('oldTitle') or None
+
+    def _get_type_detail(self, detail: dict) -> str:
+        return detail['type']
+
+    def _get_permission_detail(self, detail: dict) -> list:
+        return detail['addedPermissions']
+
+    def _get_comment_detail(self, detail: dict) -> str:
+        detail.pop('mentionedUsers')
+        return detail[self.getOneOf(detail)]['subtype']
+
+    def _get_settings_detail(self, detail: dict) -> str:
+        return detail['restrictionChanges'][0]['newRestriction']
+
+    # action 종류별 상세 정보 추출, 목록에 없으면 None
+    ACTION_HANDLERS = {
+        'create': _get_create_detail,
+        'move': _get_move_detail,
+        'rename': _get_rename_detail,
+        'delete': _get_type_detail,
+        'restore': _get_type_detail,
+        'dlpChange': _get_type_detail,
+        'reference': _get_type_detail,
+        'permissionChange': _get_permission_detail,
+        'comment': _get_comment_detail,
+        'settingsChange': _get_settings_detail,
+    }
+
     def get_move_from(self, action_detail: dict) -> str:
         removed_parents = action_detail['move'].get('removedParents', [{}])
         return self.getTargetInfo(removed_parents[0])
@@ -349,43 +431,17 @@ class ActivityPoller(GoogleDrivePoller):
     def getActionInfo(self, actionDetail: dict) -> tuple:
         # Returns the type of action.
         for key in actionDetail:
-            match key:
-                case 'create':
-                    action_detail = self.getOneOf(actionDetail[key])
-                case 'move' if actionDetail[key].get('removedParents'):
-                    action_detail: tuple = self.getTargetInfo(actionDetail[key]["removedParents"][0])
-                case 'rename' if actionDetail[key].get('oldTitle'):
-                    action_detail = actionDetail[key]['oldTitle']
-                case 'delete' | 'restore' | 'dlpChange' | 'reference':
-                    action_detail = actionDetail[key]['type']
-                case 'permissionChange':
-                    action_detail = actionDetail[key]['addedPermissions']
-                case 'comment':
-                    actionDetail[key].pop('mentionedUsers')
-                    action_detail = actionDetail[key][self.getOneOf(actionDetail[key])]['subtype']
-                case 'settingsChange':
-                    action_detail = actionDetail[key]['restrictionChanges'][0]['newRestriction']
-                case _:
-                    action_detail = None
-            return key, action_detail
+            handler = self.ACTION_HANDLERS.get(key)
+            return key, handler(self, actionDetail[key]) if handler else None
         return 'unknown', None
 
     def getTargetInfo(self, target: dict) -> tuple:
         # Returns the type of a target and an associated title.
-        if 'driveItem' in target:
-            title = target['driveItem'].get('title', 'unknown')
-            name = target['driveItem'].get('name')
-            mimeType = target['driveItem'].get('mimeType')
-            return title, name, mimeType
-        if 'drive' in target:
-            title = target['drive'].get('title', 'unknown')
-            name = target['drive'].get('name')
-            mimeType = target['drive'].get('mimeType')
-            return title, name, mimeType
-        if 'fileComment' in target:
-            parent = target['fileComment'].get('parent', {})
-            title = parent.get('title', 'unknown')
-            name = parent.get('name')
-            mimeType = parent.get('mimeType')
-            return title, name, mimeType
+        for key in TARGET_KEYS:
+            item = target.get(key)
+            if item is None:
+                continue
+            if key == 'fileComment':
+                item = item.get('parent', EMPTY_DICT)
+            return item.get('title', 'unknown'), item.get('name'), item.get('mimeType')
         return self.getOneOf(target), None, None